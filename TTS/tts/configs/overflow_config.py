@@ -50,6 +50,10 @@ class OverflowConfig(BaseTTSConfig):  # The classname has to be camel case
             Threshold for duration quantiles. Defaults to 0.55. Tune this to change the speaking rate of the synthesis, where lower values defines a slower speaking rate and higher values defines a faster speaking rate.
         use_grad_checkpointing (bool):
             Use gradient checkpointing to save memory. In a multi-GPU setting currently pytorch does not supports gradient checkpoint inside a loop so we will have to turn it off then.Adjust depending on whatever get more batch size either by using a single GPU or multi-GPU. Defaults to True.
+        grad_checkpointing_chunk_size (int):
+            Number of timesteps of the neural HMM recomputed together per gradient checkpoint. Larger values lower the per-checkpoint overhead at the cost of memory. Defaults to 16.
+        use_bf16_emissions (bool):
+            Compute the elementwise emission log probabilities in bfloat16 to halve their memory traffic, the reduction over the mel channels and the forward recursion stay in float32. Mostly useful on GPUs with native bfloat16 support. Defaults to False.
         max_sampling_time (int):
             Maximum sampling time while synthesising latents from neural HMM. Defaults to 1000.
         prenet_type (str):
@@ -134,6 +138,8 @@ class OverflowConfig(BaseTTSConfig):  # The classname has to be camel case
     deterministic_transition: bool = True
     duration_threshold: float = 0.55
     use_grad_checkpointing: bool = True
+    grad_checkpointing_chunk_size: int = 16
+    use_bf16_emissions: bool = False
     max_sampling_time: int = 1000
 
     ## Prenet parameters
@@ -191,8 +197,12 @@ class OverflowConfig(BaseTTSConfig):  # The classname has to be camel case
         Raises:
             AssertionError: when the parameters network is not defined
             AssertionError: transition probability is not between 0 and 1
+            AssertionError: gradient checkpointing chunk size is not positive
         """
         assert self.ar_order > 0, "AR order must be greater than 0 it is an autoregressive model."
+        assert (
+            self.grad_checkpointing_chunk_size > 0
+        ), f"Gradient checkpointing chunk size must be greater than 0. Provided: {self.grad_checkpointing_chunk_size}"
         assert (
             len(self.outputnet_size) >= 1
         ), f"Parameter Network must have atleast one layer check the config file for parameter network. Provided: {self.parameternetwork}"
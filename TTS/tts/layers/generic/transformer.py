@@ -26,7 +26,9 @@ class FFTransformer(nn.Module):
         src = self.norm1(src + src2)
         # T x B x D -> B x D x T
         src = src.permute(1, 2, 0)
-        src2 = self.conv2(F.relu(self.conv1(src)))
+        # zero the padded frames so that the convolutions do not mix them into the valid ones
+        conv_mask = 1 if src_key_padding_mask is None else (~src_key_padding_mask).unsqueeze(1).to(src.dtype)
+        src2 = self.conv2(F.relu(self.conv1(src * conv_mask)) * conv_mask)
         src2 = self.dropout2(src2)
         src = src + src2
         src = src.transpose(1, 2)
@@ -58,6 +60,7 @@ class FFTransformerBlock(nn.Module):
             - mask:  :math:`[B, 1, T] or [B, T]`
         """
         if mask is not None and mask.ndim == 3:
+            x = x * mask
             mask = mask.squeeze(1)
             # mask is negated, torch uses 1s and 0s reversely.
             mask = ~mask.bool()
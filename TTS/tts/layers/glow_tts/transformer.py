@@ -126,16 +126,17 @@ class RelativePositionMultiHeadAttention(nn.Module):
         query = query.view(b, self.num_heads, self.k_channels, t_t).transpose(2, 3)
         key = key.view(b, self.num_heads, self.k_channels, t_s).transpose(2, 3)
         value = value.view(b, self.num_heads, self.k_channels, t_s).transpose(2, 3)
+        # scale the queries once instead of the [b, n_h, t_t, t_s] scores and relative logits
+        query = query / math.sqrt(self.k_channels)
         # compute raw attention scores
-        scores = torch.matmul(query, key.transpose(-2, -1)) / math.sqrt(self.k_channels)
+        scores = torch.matmul(query, key.transpose(-2, -1))
         # relative positional encoding for scores
         if self.rel_attn_window_size is not None:
             assert t_s == t_t, "Relative attention is only available for self-attention."
             # get relative key embeddings
             key_relative_embeddings = self._get_relative_embeddings(self.emb_rel_k, t_s)
             rel_logits = self._matmul_with_relative_keys(query, key_relative_embeddings)
-            rel_logits = self._relative_position_to_absolute_position(rel_logits)
-            scores_local = rel_logits / math.sqrt(self.k_channels)
+            scores_local = self._relative_position_to_absolute_position(rel_logits)
             scores = scores + scores_local
         # proximan bias
         if self.proximal_bias:
@@ -312,6 +312,22 @@ class OverflowUtils:
         s = (x - m.masked_fill_(mask, 0).unsqueeze(dim=dim)).exp().sum(dim=dim)
         return s.masked_fill_(mask, 1).log() + m.masked_fill_(mask, -float("inf"))
 
+    @staticmethod
+    def logaddexp(x, y):
+        r"""
+        Differentiable LogAddExp of two tensors: same as `logsumexp` over a stack of
+            `x` and `y` without allocating the stacked tensor, and unlike `torch.logaddexp`
+            it yields 0 gradients instead of nans when both inputs are -inf.
+        Args:
+            x : torch.Tensor -  The first input tensor
+            y : torch.Tensor -  The second input tensor, same shape as x
+        """
+        m = torch.maximum(x, y)
+        mask = m == -float("inf")
+        m = m.masked_fill(mask, 0)
+        s = (x - m).exp() + (y - m).exp()
+        return s.masked_fill_(mask, 1).log() + m.masked_fill_(mask, -float("inf"))
+
     @staticmethod
     def double_pad(list_of_different_shape_tensors):
         r"""
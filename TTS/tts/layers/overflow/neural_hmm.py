@@ -1,7 +1,7 @@
+import math
 from typing import List
 
 import torch
-import torch.distributions as tdist
 import torch.nn.functional as F
 from torch import nn
 from torch.utils.checkpoint import checkpoint
@@ -43,6 +43,8 @@ class NeuralHMM(nn.Module):
         flat_start_params (dict): Parameters for the flat start initialization of the neural HMM.
         std_floor (float): Floor value for the standard deviation of the neural HMM. Prevents model cheating by putting point mass and getting infinite likelihood at any datapoint.
         use_grad_checkpointing (bool, optional): Use gradient checkpointing to save memory. Defaults to True.
+        grad_checkpointing_chunk_size (int, optional): Number of timesteps recomputed together per checkpoint. Defaults to 16.
+        use_bf16_emissions (bool, optional): Compute the elementwise emission log probabilities in bfloat16. Defaults to False.
     """
 
     def __init__(
@@ -61,6 +63,8 @@ class NeuralHMM(nn.Module):
         flat_start_params: dict,
         std_floor: float,
         use_grad_checkpointing: bool = True,
+        grad_checkpointing_chunk_size: int = 16,
+        use_bf16_emissions: bool = False,
     ):
         super().__init__()
 
@@ -70,11 +74,15 @@ class NeuralHMM(nn.Module):
         self.prenet_dim = prenet_dim
         self.memory_rnn_dim = memory_rnn_dim
         self.use_grad_checkpointing = use_grad_checkpointing
+        self.grad_checkpointing_chunk_size = grad_checkpointing_chunk_size
 
         self.transition_model = TransitionModel()
-        self.emission_model = EmissionModel()
+        self.emission_model = EmissionModel(compute_dtype=torch.bfloat16 if use_bf16_emissions else None)
 
         assert ar_order > 0, f"AR order must be greater than 0 provided {ar_order}"
+        assert (
+            grad_checkpointing_chunk_size > 0
+        ), f"Gradient checkpointing chunk size must be greater than 0 provided {grad_checkpointing_chunk_size}"
 
         self.ar_order = ar_order
         self.prenet = Prenet(
@@ -110,40 +118,60 @@ class NeuralHMM(nn.Module):
             log_prob (torch.FloatTensor): Log probability of the sequence
         """
         # Get dimensions of inputs
-        batch_size, N, _ = inputs.shape
-        T_max = torch.max(mel_lens)
+        batch_size = inputs.shape[0]
+        T_max = torch.max(mel_lens).item()
         mels = mels.permute(0, 2, 1)
 
         # Intialize forward algorithm
         log_state_priors = self._initialize_log_state_priors(inputs)
-        log_c, log_alpha_scaled, transition_matrix, means = self._initialize_forward_algorithm_variables(mels, N)
 
         # Initialize autoregression elements
         ar_inputs = self._add_go_token(mels)
+        memory_inputs = self._precompute_memory_inputs(ar_inputs)
         h_memory, c_memory = self._init_lstm_states(batch_size, self.memory_rnn_dim, mels)
 
-        for t in range(T_max):
-            # Process Autoregression
-            h_memory, c_memory = self._process_ar_timestep(t, ar_inputs, h_memory, c_memory)
-            # Get mean, std and transition vector from decoder for this timestep
-            # Note: Gradient checkpointing currently doesn't works with multiple gpus inside a loop
-            if self.use_grad_checkpointing and self.training:
-                mean, std, transition_vector = checkpoint(self.output_net, h_memory, inputs)
+        # Phase 1: autoregression, parameter generation and emissions, only the memory rnn is sequential here.
+        # It runs in chunks of timesteps, each chunk is a single gradient checkpoint. With checkpointing the
+        # (B, T_chunk, N, D_mel) parameters are recomputed in the backward pass instead of being stored for the
+        # whole sequence, only the detached means of the first item are kept for plotting.
+        # Note: Gradient checkpointing currently doesn't works with multiple gpus inside a loop
+        use_grad_checkpointing = self.use_grad_checkpointing and self.training
+        emissions, transition_matrix = [], []
+        # Saving the means of the plotted (first) item only, will not have gradient tapes
+        means = mels.new_empty((1, T_max, inputs.shape[1], mels.shape[2]))
+        for t_start in range(0, T_max, self.grad_checkpointing_chunk_size):
+            t_end = min(t_start + self.grad_checkpointing_chunk_size, T_max)
+            chunk_args = (t_start, t_end, ar_inputs, mels, h_memory, c_memory, inputs, inputs_len, memory_inputs)
+            if use_grad_checkpointing:
+                h_memory, c_memory, chunk_emissions, chunk_transitions, chunk_means = checkpoint(
+                    self._forward_chunk, *chunk_args, use_reentrant=False
+                )
             else:
-                mean, std, transition_vector = self.output_net(h_memory, inputs)
-
+                h_memory, c_memory, chunk_emissions, chunk_transitions, chunk_means = self._forward_chunk(*chunk_args)
+            emissions.append(chunk_emissions)
+            transition_matrix.append(chunk_transitions)
+            means[:, t_start:t_end] = chunk_means
+        emissions = torch.cat(emissions, dim=1)
+        transition_matrix = torch.cat(transition_matrix, dim=1)  # needed for absorption state calculation
+
+        # Phase 2: forward recursion, no network calls left in this loop. The per-timestep results are
+        # kept as loop locals and stacked once at the end instead of being written into preallocated buffers.
+        log_c, log_alpha_scaled = [], []
+        prev_log_alpha_scaled = log_state_priors
+        inputs_len_mask = sequence_mask(inputs_len, max_len=inputs.shape[1])
+        for t in range(T_max):
             if t == 0:
-                log_alpha_temp = log_state_priors + self.emission_model(mels[:, 0], mean, std, inputs_len)
+                log_alpha_temp = prev_log_alpha_scaled + emissions[:, 0]
             else:
-                log_alpha_temp = self.emission_model(mels[:, t], mean, std, inputs_len) + self.transition_model(
-                    log_alpha_scaled[:, t - 1, :], transition_vector, inputs_len
+                log_alpha_temp = emissions[:, t] + self.transition_model(
+                    prev_log_alpha_scaled, transition_matrix[:, t], inputs_len_mask
                 )
-            log_c[:, t] = torch.logsumexp(log_alpha_temp, dim=1)
-            log_alpha_scaled[:, t, :] = log_alpha_temp - log_c[:, t].unsqueeze(1)
-            transition_matrix[:, t] = transition_vector  # needed for absorption state calculation
-
-            # Save for plotting
-            means.append(mean.detach())
+            log_c_t = torch.logsumexp(log_alpha_temp, dim=1)
+            prev_log_alpha_scaled = log_alpha_temp - log_c_t.unsqueeze(1)
+            log_c.append(log_c_t)
+            log_alpha_scaled.append(prev_log_alpha_scaled)
+        log_c = torch.stack(log_c, dim=1)
+        log_alpha_scaled = torch.stack(log_alpha_scaled, dim=1)
 
         log_c, log_alpha_scaled = self._mask_lengths(mel_lens, log_c, log_alpha_scaled)
 
@@ -155,6 +183,49 @@ class NeuralHMM(nn.Module):
 
         return log_probs, log_alpha_scaled, transition_matrix, means
 
+    def _forward_chunk(
+        self, t_start, t_end, ar_inputs, mels, h_memory, c_memory, inputs, inputs_len, memory_inputs=None
+    ):
+        r"""Runs the autoregression, generates the emission and transition parameters and computes the
+        emission log likelihoods of a chunk of timesteps. A whole chunk is checkpointed at once, so the
+        recomputation in the backward pass runs ``grad_checkpointing_chunk_size`` steps per checkpoint
+        boundary instead of one.
+
+        Args:
+            t_start (int): first mel-spec timestep of the chunk
+            t_end (int): mel-spec timestep after the last one of the chunk
+            ar_inputs (torch.FloatTensor): go-token appended mel-spectrograms
+            mels (torch.FloatTensor): mel-spectrograms
+            h_memory (torch.FloatTensor): rnn hidden state before the chunk
+            c_memory (torch.FloatTensor): rnn cell state before the chunk
+            inputs (torch.FloatTensor): Encoder outputs
+            inputs_len (torch.LongTensor): Encoder output lengths
+            memory_inputs (torch.FloatTensor, optional): prenet outputs of all timesteps. Defaults to None.
+
+        Shapes:
+            - ar_inputs: (B, T_mel, D_mel)
+            - mels: (B, T_mel, D_mel)
+            - h_memory, c_memory: (B, memory_rnn_dim)
+            - inputs: (B, N, D_out_enc)
+            - inputs_len: (B)
+            - memory_inputs: (B, T_mel, prenet_dim)
+
+        Returns:
+            h_memory, c_memory, emissions (B, T_chunk, N), transition_vectors (B, T_chunk, N),
+            means (1, T_chunk, N, D_mel) of the first item detached for plotting
+        """
+        means, stds, transition_vectors = [], [], []
+        for t in range(t_start, t_end):
+            h_memory, c_memory = self._process_ar_timestep(t, ar_inputs, h_memory, c_memory, memory_inputs)
+            # Get mean, std and transition vector from decoder for this timestep
+            mean, std, transition_vector = self.output_net(h_memory, inputs)
+            means.append(mean)
+            stds.append(std)
+            transition_vectors.append(transition_vector)
+        means = torch.stack(means, dim=1)
+        emissions = self.emission_model(mels[:, t_start:t_end], means, torch.stack(stds, dim=1), inputs_len)
+        return h_memory, c_memory, emissions, torch.stack(transition_vectors, dim=1), means[:1].detach()
+
     @staticmethod
     def _mask_lengths(mel_lens, log_c, log_alpha_scaled):
         """
@@ -180,12 +251,14 @@ class NeuralHMM(nn.Module):
         ar_inputs,
         h_memory,
         c_memory,
+        memory_inputs=None,
     ):
         """
         Process autoregression in timestep
         1. At a specific t timestep
         2. Perform data dropout if applied (we did not use it)
-        3. Run the autoregressive frame through the prenet (has dropout)
+        3. Run the autoregressive frame through the prenet (has dropout),
+            unless the prenet outputs are already precomputed
         4. Run the prenet output through the post prenet rnn
 
         Args:
@@ -196,16 +269,46 @@ class NeuralHMM(nn.Module):
                 - shape: (b, memory_rnn_dim)
             c_post_prenet (torch.FloatTensor): previous timestep rnn cell state
                 - shape: (b, memory_rnn_dim)
+            memory_inputs (torch.FloatTensor, optional): precomputed prenet outputs of all timesteps
+                - shape: (b, T_out, prenet_dim)
 
         Returns:
             h_post_prenet (torch.FloatTensor): rnn hidden state of the current timestep
             c_post_prenet (torch.FloatTensor): rnn cell state of the current timestep
         """
-        prenet_input = ar_inputs[:, t : t + self.ar_order].flatten(1)
-        memory_inputs = self.prenet(prenet_input)
-        h_memory, c_memory = self.memory_rnn(memory_inputs, (h_memory, c_memory))
+        if memory_inputs is None:
+            prenet_input = ar_inputs[:, t : t + self.ar_order].flatten(1)
+            memory_input = self.prenet(prenet_input)
+        else:
+            memory_input = memory_inputs[:, t]
+        h_memory, c_memory = self.memory_rnn(memory_input, (h_memory, c_memory))
         return h_memory, c_memory
 
+    def _precompute_memory_inputs(self, ar_inputs):
+        """Run the prenet over all the timesteps in a single batched call.
+
+        With teacher forcing every autoregressive input is known before the loop starts, so
+        only the memory rnn has to stay sequential. The BN prenet normalises with the batch
+        statistics of a single timestep, so it is still run timestep by timestep, but outside
+        of the checkpointed chunks so that recomputation does not update its running statistics.
+
+        Args:
+            ar_inputs (torch.FloatTensor): go-token appended mel-spectrograms
+                - shape: (b, T_out, D_out)
+
+        Returns:
+            memory_inputs (torch.FloatTensor): prenet outputs
+                - shape: (b, T_out - ar_order + 1, prenet_dim)
+        """
+        b = ar_inputs.shape[0]
+        # (b, T, D) -> (b, T - ar_order + 1, D, ar_order) -> same layout as ar_inputs[:, t : t + ar_order].flatten(1)
+        # materialised once, so that every timestep below is a view instead of a flatten copy
+        prenet_inputs = ar_inputs.unfold(1, self.ar_order, 1).transpose(2, 3)
+        prenet_inputs = prenet_inputs.reshape(b, -1, self.ar_order * self.frame_channels)
+        if self.prenet.prenet_type != "original":
+            return torch.stack([self.prenet(prenet_input) for prenet_input in prenet_inputs.unbind(1)], dim=1)
+        return self.prenet(prenet_inputs)
+
     def _add_go_token(self, mel_inputs):
         """Append the go token to create the autoregressive input
         Args:
@@ -218,26 +321,6 @@ class NeuralHMM(nn.Module):
         ar_inputs = torch.cat((go_tokens, mel_inputs), dim=1)[:, :T]
         return ar_inputs
 
-    @staticmethod
-    def _initialize_forward_algorithm_variables(mel_inputs, N):
-        r"""Initialize placeholders for forward algorithm variables, to use a stable
-                version we will use log_alpha_scaled and the scaling constant
-
-        Args:
-            mel_inputs (torch.FloatTensor): (b, T_max, frame_channels)
-            N (int): number of states
-        Returns:
-            log_c (torch.FloatTensor): Scaling constant (b, T_max)
-        """
-        b, T_max, _ = mel_inputs.shape
-        log_alpha_scaled = mel_inputs.new_zeros((b, T_max, N))
-        log_c = mel_inputs.new_zeros(b, T_max)
-        transition_matrix = mel_inputs.new_zeros((b, T_max, N))
-
-        # Saving for plotting later, will not have gradient tapes
-        means = []
-        return log_c, log_alpha_scaled, transition_matrix, means
-
     @staticmethod
     def _init_lstm_states(batch_size, hidden_state_dim, device_tensor):
         r"""
@@ -288,19 +371,16 @@ class NeuralHMM(nn.Module):
             sum_final_log_c (torch.FloatTensor): (batch_size)
 
         """
-        N = torch.max(inputs_len)
         max_inputs_len = log_alpha_scaled.shape[2]
         state_lengths_mask = sequence_mask(inputs_len, max_len=max_inputs_len)
 
-        last_log_alpha_scaled_index = (
-            (mels_len - 1).unsqueeze(-1).expand(-1, N).unsqueeze(1)
-        )  # Batch X Hidden State Size
-        last_log_alpha_scaled = torch.gather(log_alpha_scaled, 1, last_log_alpha_scaled_index).squeeze(1)
+        # (batch, timestep) pairs of the last timestep, shared by both lookups
+        last_timestep_index = (torch.arange(mels_len.shape[0], device=mels_len.device), mels_len - 1)
+        last_log_alpha_scaled = log_alpha_scaled[last_timestep_index]  # Batch X Hidden State Size
         last_log_alpha_scaled = last_log_alpha_scaled.masked_fill(~state_lengths_mask, -float("inf"))
 
-        last_transition_vector = torch.gather(transition_vector, 1, last_log_alpha_scaled_index).squeeze(1)
-        last_transition_probability = torch.sigmoid(last_transition_vector)
-        log_probability_of_transitioning = OverflowUtils.log_clamped(last_transition_probability)
+        last_transition_vector = transition_vector[last_timestep_index]
+        log_probability_of_transitioning = F.logsigmoid(last_transition_vector)
 
         last_transition_probability_index = self.get_mask_for_last_item(inputs_len, inputs_len.device)
         log_probability_of_transitioning = log_probability_of_transitioning.masked_fill(
@@ -403,7 +483,7 @@ class NeuralHMM(nn.Module):
             input_parameters (list[torch.FloatTensor]): Input parameters
             output_parameters (list[torch.FloatTensor]): Output parameters
         """
-        states_travelled, outputs, t = [], [], 0
+        states_travelled, t = [], 0
 
         # Sample initial state
         current_state = 0
@@ -412,17 +492,16 @@ class NeuralHMM(nn.Module):
         # Prepare autoregression
         prenet_input = self.go_tokens.unsqueeze(0).expand(1, self.ar_order, self.frame_channels)
         h_memory, c_memory = self._init_lstm_states(1, self.memory_rnn_dim, prenet_input)
+        # Every state emits at least one frame, so without a max sampling time the buffer starts at the
+        # number of states and doubles whenever it is full
+        outputs = prenet_input.new_empty(max_sampling_time or inputs.shape[1], self.frame_channels)
 
         input_parameter_values = []
         output_parameter_values = []
         quantile = 1
         while True:
-            memory_input = self.prenet(prenet_input.flatten(1).unsqueeze(0))
-            # will be 1 while sampling
-            h_memory, c_memory = self.memory_rnn(memory_input.squeeze(0), (h_memory, c_memory))
-
             z_t = inputs[:, current_state].unsqueeze(0)  # Add fake time dimension
-            mean, std, transition_vector = self.output_net(h_memory, z_t)
+            h_memory, c_memory, mean, std, transition_vector = self._sample_step(prenet_input, h_memory, c_memory, z_t)
 
             transition_probability = torch.sigmoid(transition_vector.flatten())
             staying_probability = torch.sigmoid(-transition_vector.flatten())
@@ -436,12 +515,14 @@ class NeuralHMM(nn.Module):
             # Prepare autoregressive input for next iteration
             prenet_input = torch.cat((prenet_input, x_t), dim=1)[:, 1:]
 
-            outputs.append(x_t.flatten())
+            if t == outputs.shape[0]:
+                outputs = torch.cat((outputs, torch.empty_like(outputs)))
+            outputs[t] = x_t.flatten()
 
-            transition_matrix = torch.cat((staying_probability, transition_probability))
             quantile *= staying_probability
             if not self.deterministic_transition:
-                switch = transition_matrix.multinomial(1)[0].item()
+                # a single Bernoulli draw, the choice is only between staying and transitioning
+                switch = (torch.rand_like(transition_probability) < transition_probability).item()
             else:
                 switch = quantile < duration_threshold
 
@@ -457,12 +538,38 @@ class NeuralHMM(nn.Module):
             t += 1
 
         return (
-            torch.stack(outputs, dim=0),
+            outputs[: t + 1],
             F.one_hot(input_lens.new_tensor(states_travelled)),
             input_parameter_values,
             output_parameter_values,
         )
 
+    def _sample_step(self, prenet_input, h_memory, c_memory, z_t):
+        """Network part of one autoregressive sampling step.
+
+        Only fixed shape tensors go in and out, the state bookkeeping stays in ``sample``. This makes
+        the step a static graph that can be captured, e.g.
+        ``neural_hmm._sample_step = torch.compile(neural_hmm._sample_step, mode="reduce-overhead")``.
+
+        Args:
+            prenet_input (torch.FloatTensor): previous ``ar_order`` frames
+                - shape: :math:`(1, ar_order, D_mel)`
+            h_memory (torch.FloatTensor): previous rnn hidden state
+                - shape: :math:`(1, memory_rnn_dim)`
+            c_memory (torch.FloatTensor): previous rnn cell state
+                - shape: :math:`(1, memory_rnn_dim)`
+            z_t (torch.FloatTensor): encoder output of the current state
+                - shape: :math:`(1, 1, d)`
+
+        Returns:
+            h_memory, c_memory, mean (1, 1, D_mel), std (1, 1, D_mel), transition_vector (1, 1)
+        """
+        memory_input = self.prenet(prenet_input.flatten(1).unsqueeze(0))
+        # will be 1 while sampling
+        h_memory, c_memory = self.memory_rnn(memory_input.squeeze(0), (h_memory, c_memory))
+        mean, std, transition_vector = self.output_net(h_memory, z_t)
+        return h_memory, c_memory, mean, std, transition_vector
+
     @staticmethod
     def _initialize_log_state_priors(text_embeddings):
         """Creates the log pi in forward algorithm.
@@ -484,7 +591,7 @@ class TransitionModel(nn.Module):
     """Transition Model of the HMM, it represents the probability of transitioning
     form current state to all other states"""
 
-    def forward(self, log_alpha_scaled, transition_vector, inputs_len):  # pylint: disable=no-self-use
+    def forward(self, log_alpha_scaled, transition_vector, inputs_len_mask):  # pylint: disable=no-self-use
         r"""
         product of the past state with transitional probabilities in log space
 
@@ -494,49 +601,54 @@ class TransitionModel(nn.Module):
                 - shape: (batch size, N)
             transition_vector (torch.tensor): transition vector for each state
                 - shape: (N)
-            inputs_len (int tensor): Lengths of states in a batch
-                - shape: (batch)
+            inputs_len_mask (bool tensor): Mask of the states in a batch, computed once by the caller
+                - shape: (batch, N)
 
         Returns:
             out (torch.FloatTensor): log probability of transitioning to each state
         """
-        transition_p = torch.sigmoid(transition_vector)
-        staying_p = torch.sigmoid(-transition_vector)
-
-        log_staying_probability = OverflowUtils.log_clamped(staying_p)
-        log_transition_probability = OverflowUtils.log_clamped(transition_p)
+        # log(sigmoid(-x)) = log(1 - sigmoid(x)), stable near saturation without clamping. Unlike the former
+        # clamped log these are not floored at log(1e-4), saturated transitions keep their values and gradients
+        log_staying_probability = F.logsigmoid(-transition_vector)
+        log_transition_probability = F.logsigmoid(transition_vector)
 
         staying = log_alpha_scaled + log_staying_probability
-        leaving = log_alpha_scaled + log_transition_probability
-        leaving = leaving.roll(1, dims=1)
-        leaving[:, 0] = -float("inf")
-        inputs_len_mask = sequence_mask(inputs_len)
-        out = OverflowUtils.logsumexp(torch.stack((staying, leaving), dim=2), dim=2)
+        # shift right by one state: state 0 can not be entered by leaving another state
+        leaving = F.pad(log_alpha_scaled[:, :-1] + log_transition_probability[..., :-1], (1, 0), value=-float("inf"))
+        out = OverflowUtils.logaddexp(staying, leaving)
         out = out.masked_fill(~inputs_len_mask, -float("inf"))  # There are no states to contribute to the loss
         return out
 
 
 class EmissionModel(nn.Module):
     """Emission Model of the HMM, it represents the probability of
-    emitting an observation based on the current state"""
+    emitting an observation based on the current state
+
+    Args:
+        compute_dtype (torch.dtype, optional): dtype of the elementwise log probabilities. The difference between
+            the observations and the means and the sum over the feature dimension stay in the dtype of the means.
+            Defaults to None.
+    """
 
-    def __init__(self) -> None:
+    def __init__(self, compute_dtype: torch.dtype = None) -> None:
         super().__init__()
-        self.distribution_function: tdist.Distribution = tdist.normal.Normal
+        self.compute_dtype = compute_dtype
 
     def sample(self, means, stds, sampling_temp):
-        return self.distribution_function(means, stds * sampling_temp).sample() if sampling_temp > 0 else means
+        return means + stds * sampling_temp * torch.randn_like(means) if sampling_temp > 0 else means
 
     def forward(self, x_t, means, stds, state_lengths):
         r"""Calculates the log probability of the the given data (x_t)
-            being observed from states with given means and stds
+            being observed from states with given means and stds.
+            Either a single timestep or all the timesteps at once
+            with an extra time dimension after the batch dimension.
         Args:
             x_t (float tensor) : observation at current time step
-                - shape: (batch, feature_dim)
+                - shape: (batch, feature_dim) or (batch, T, feature_dim)
             means (float tensor): means of the distributions of hidden states
-                - shape: (batch, hidden_state, feature_dim)
+                - shape: (batch, hidden_state, feature_dim) or (batch, T, hidden_state, feature_dim)
             stds (float tensor): standard deviations of the distributions of the hidden states
-                - shape: (batch, hidden_state, feature_dim)
+                - shape: (batch, hidden_state, feature_dim) or (batch, T, hidden_state, feature_dim)
             state_lengths (int tensor): Lengths of states in a batch
                 - shape: (batch)
 
@@ -544,10 +656,17 @@ class EmissionModel(nn.Module):
             out (float tensor): observation log likelihoods,
                                     expressing the probability of an observation
                 being generated from a state i
-                shape: (batch, hidden_state)
+                shape: (batch, hidden_state) or (batch, T, hidden_state)
         """
-        emission_dists = self.distribution_function(means, stds)
-        out = emission_dists.log_prob(x_t.unsqueeze(1))
-        state_lengths_mask = sequence_mask(state_lengths).unsqueeze(2)
-        out = torch.sum(out * state_lengths_mask, dim=2)
+        dtype = means.dtype
+        # the means sit close to the observations, so the difference is taken before any downcast
+        diff = x_t.unsqueeze(-2) - means
+        if self.compute_dtype is not None:
+            diff, stds = diff.to(self.compute_dtype), stds.to(self.compute_dtype)
+        # Normal log density written out, a Distribution object validates and broadcasts its arguments per call
+        z = diff / stds
+        out = -0.5 * z.square() - stds.log() - 0.5 * math.log(2 * math.pi)
+        batch_size, N = means.shape[0], means.shape[-2]
+        state_lengths_mask = sequence_mask(state_lengths, max_len=N).view(batch_size, *([1] * (means.dim() - 3)), N)
+        out = torch.sum(out, dim=-1, dtype=dtype) * state_lengths_mask
         return out
@@ -1,3 +1,5 @@
+import bisect
+import contextlib
 from dataclasses import dataclass, field
 from typing import Dict, List, Union
 
@@ -18,6 +20,24 @@ from TTS.tts.utils.visual import plot_alignment, plot_spectrogram
 from TTS.utils.io import load_fsspec
 
 
+@torch.jit.script
+def compute_mdn_log_probs(mu: torch.Tensor, log_sigma: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+    # expand (y - mu)^2 / sigma^2 into matmuls so that the [B, T2, T1, D] tensor is never materialized
+    inv_var = torch.exp(-2 * log_sigma)  # [B, D, T2]
+    logp2 = torch.matmul(inv_var.transpose(1, 2), y**2)  # [B, T2, D] x [B, D, T1] = [B, T2, T1]
+    logp3 = torch.matmul((mu * inv_var).transpose(1, 2), y)  # [B, T2, D] x [B, D, T1] = [B, T2, T1]
+    logp4 = torch.sum(mu**2 * inv_var, 1).unsqueeze(-1)  # [B, T2, 1]
+    exponential = -0.5 * (logp2 - 2 * logp3 + logp4) / mu.shape[1]  # B, L, T
+    logp = exponential - 0.5 * log_sigma.mean(dim=1).unsqueeze(-1)
+    return logp
+
+
+@torch.jit.script
+def round_log_durations(o_dr_log: torch.Tensor, x_mask: torch.Tensor, length_scale: float) -> torch.Tensor:
+    o_dr = (torch.exp(o_dr_log) - 1) * x_mask * length_scale
+    return torch.round(o_dr.clamp_(min=1.0))
+
+
 @dataclass
 class AlignTTSArgs(Coqpit):
     """
@@ -46,6 +66,9 @@ class AlignTTSArgs(Coqpit):
             enable external speaker embeddings. Defaults to False.
         c_in_channels (int, optional):
             number of channels in speaker embedding vectors. Defaults to 0.
+        use_bf16_inference (bool, optional):
+            run the decoder under bfloat16 autocast at inference. The encoder and the duration predictor stay in
+            float32 so the predicted durations are the same as without it. Defaults to False.
     """
 
     num_chars: int = None
@@ -65,6 +88,7 @@ class AlignTTSArgs(Coqpit):
     use_speaker_embedding: bool = False
     use_d_vector_file: bool = False
     d_vector_dim: int = 0
+    use_bf16_inference: bool = False
 
 
 class AlignTTS(BaseTTS):
@@ -146,18 +170,15 @@ class AlignTTS(BaseTTS):
         if self.embedded_speaker_dim > 0 and self.embedded_speaker_dim != config.model_args.hidden_channels:
             self.proj_g = nn.Conv1d(self.embedded_speaker_dim, config.model_args.hidden_channels, 1)
 
+        # branch flags set once here instead of `hasattr` checks on every call
+        # speaker-id conditioning is not supported, `forward` and `inference` only read d-vectors
+        self.has_emb_g = False
+        self.has_proj_g = hasattr(self, "proj_g")
+        self.use_pos_encoder = True
+
     @staticmethod
     def compute_log_probs(mu, log_sigma, y):
-        # pylint: disable=protected-access, c-extension-no-member
-        y = y.transpose(1, 2).unsqueeze(1)  # [B, 1, T1, D]
-        mu = mu.transpose(1, 2).unsqueeze(2)  # [B, T2, 1, D]
-        log_sigma = log_sigma.transpose(1, 2).unsqueeze(2)  # [B, T2, 1, D]
-        expanded_y, expanded_mu = torch.broadcast_tensors(y, mu)
-        exponential = -0.5 * torch.mean(
-            torch._C._nn.mse_loss(expanded_y, expanded_mu, 0) / torch.pow(log_sigma.exp(), 2), dim=-1
-        )  # B, L, T
-        logp = exponential - 0.5 * log_sigma.mean(dim=-1)
-        return logp
+        return compute_mdn_log_probs(mu, log_sigma, y)
 
     def compute_align_path(self, mu, log_sigma, y, x_mask, y_mask):
         # find the max alignment path
@@ -179,9 +200,11 @@ class AlignTTS(BaseTTS):
         attn = generate_path(dr, attn_mask.squeeze(1)).to(dr.dtype)
         return attn
 
-    def expand_encoder_outputs(self, en, dr, x_mask, y_mask):
-        """Generate attention alignment map from durations and
-        expand encoder outputs
+    @staticmethod
+    def gather_encoder_outputs(en, dr, x_mask, y_mask):
+        """Expand encoder outputs by the durations without building the
+        attention alignment map, use `generate_attn` for the map itself.
+        Same result as multiplying the encoder outputs by that map.
 
         Examples::
             - encoder output: [a,b,c,d]
@@ -193,15 +216,20 @@ class AlignTTS(BaseTTS):
                              [0, 1, 1, 1, 0, 0, 0],
                              [1, 0, 0, 0, 0, 0, 0]]
         """
-        attn = self.generate_attn(dr, x_mask, y_mask)
-        o_en_ex = torch.matmul(attn.squeeze(1).transpose(1, 2), en.transpose(1, 2)).transpose(1, 2)
-        return o_en_ex, attn
+        # the alignment is hard, so the encoder output of each decoder frame is gathered by its token index.
+        # Frame j belongs to the first token whose cumulative duration exceeds j.
+        cum_dr = torch.cumsum(dr, 1)
+        frames = torch.arange(y_mask.shape[-1], device=dr.device, dtype=cum_dr.dtype).expand(dr.shape[0], -1)
+        idx = torch.searchsorted(cum_dr.contiguous(), frames.contiguous(), right=True).unsqueeze(1)  # [B, 1, T_de]
+        # frames past the total duration and frames of padded tokens stay zero, as in the masked alignment map
+        frame_mask = y_mask * (idx < en.shape[-1]).to(y_mask.dtype)
+        idx = idx.clamp_(max=en.shape[-1] - 1)
+        frame_mask = frame_mask * torch.gather(x_mask, 2, idx)
+        o_en_ex = torch.gather(en, 2, idx.expand(-1, en.shape[1], -1)) * frame_mask
+        return o_en_ex
 
     def format_durations(self, o_dr_log, x_mask):
-        o_dr = (torch.exp(o_dr_log) - 1) * x_mask * self.length_scale
-        o_dr[o_dr < 1] = 1.0
-        o_dr = torch.round(o_dr)
-        return o_dr
+        return round_log_durations(o_dr_log, x_mask, self.length_scale)
 
     @staticmethod
     def _concat_speaker_embedding(o_en, g):
@@ -211,13 +239,13 @@ class AlignTTS(BaseTTS):
 
     def _sum_speaker_embedding(self, x, g):
         # project g to decoder dim.
-        if hasattr(self, "proj_g"):
+        if self.has_proj_g:
             g = self.proj_g(g)
 
         return x + g
 
     def _forward_encoder(self, x, x_lengths, g=None):
-        if hasattr(self, "emb_g"):
+        if self.has_emb_g:
             g = nn.functional.normalize(self.speaker_embedding(g))  # [B, C, 1]
 
         if g is not None:
@@ -241,24 +269,22 @@ class AlignTTS(BaseTTS):
             o_en_dp = o_en
         return o_en, o_en_dp, x_mask, g
 
-    def _forward_decoder(self, o_en, o_en_dp, dr, x_mask, y_lengths, g):
-        y_mask = torch.unsqueeze(sequence_mask(y_lengths, None), 1).to(o_en_dp.dtype)
+    def _forward_decoder(self, o_en, o_en_dp, dr, x_mask, y_mask, g):
         # expand o_en with durations
-        o_en_ex, attn = self.expand_encoder_outputs(o_en, dr, x_mask, y_mask)
+        o_en_ex = self.gather_encoder_outputs(o_en, dr, x_mask, y_mask)
         # positional encoding
-        if hasattr(self, "pos_encoder"):
+        if self.use_pos_encoder:
             o_en_ex = self.pos_encoder(o_en_ex, y_mask)
         # speaker embedding
         if g is not None:
             o_en_ex = self._sum_speaker_embedding(o_en_ex, g)
         # decoder pass
         o_de = self.decoder(o_en_ex, y_mask, g=g)
-        return o_de, attn.transpose(1, 2)
+        return o_de
 
-    def _forward_mdn(self, o_en, y, y_lengths, x_mask):
+    def _forward_mdn(self, o_en, y, x_mask, y_mask):
         # MAS potentials and alignment
         mu, log_sigma = self.mdn_block(o_en)
-        y_mask = torch.unsqueeze(sequence_mask(y_lengths, None), 1).to(o_en.dtype)
         dr_mas, logp = self.compute_align_path(mu, log_sigma, y, x_mask, y_mask)
         return dr_mas, mu, log_sigma, logp
 
@@ -274,41 +300,41 @@ class AlignTTS(BaseTTS):
             - g: :math:`[B, C]`
         """
         y = y.transpose(1, 2)
+        # the padded length of y avoids the device sync of taking y_lengths.max()
+        y_mask = torch.unsqueeze(sequence_mask(y_lengths, y.shape[2]), 1).to(y.dtype)
         g = aux_input["d_vectors"] if "d_vectors" in aux_input else None
-        o_de, o_dr_log, dr_mas_log, attn, mu, log_sigma, logp = None, None, None, None, None, None, None
+        o_de, o_dr_log, dr_mas_log, mu, log_sigma, logp = None, None, None, None, None, None
         if phase == 0:
             # train encoder and MDN
             o_en, o_en_dp, x_mask, g = self._forward_encoder(x, x_lengths, g)
-            dr_mas, mu, log_sigma, logp = self._forward_mdn(o_en, y, y_lengths, x_mask)
-            y_mask = torch.unsqueeze(sequence_mask(y_lengths, None), 1).to(o_en_dp.dtype)
-            attn = self.generate_attn(dr_mas, x_mask, y_mask)
+            dr_mas, mu, log_sigma, logp = self._forward_mdn(o_en, y, x_mask, y_mask)
         elif phase == 1:
             # train decoder
             o_en, o_en_dp, x_mask, g = self._forward_encoder(x, x_lengths, g)
-            dr_mas, _, _, _ = self._forward_mdn(o_en, y, y_lengths, x_mask)
-            o_de, attn = self._forward_decoder(o_en.detach(), o_en_dp.detach(), dr_mas.detach(), x_mask, y_lengths, g=g)
+            dr_mas, _, _, _ = self._forward_mdn(o_en, y, x_mask, y_mask)
+            o_de = self._forward_decoder(o_en.detach(), o_en_dp.detach(), dr_mas.detach(), x_mask, y_mask, g=g)
         elif phase == 2:
             # train the whole except duration predictor
             o_en, o_en_dp, x_mask, g = self._forward_encoder(x, x_lengths, g)
-            dr_mas, mu, log_sigma, logp = self._forward_mdn(o_en, y, y_lengths, x_mask)
-            o_de, attn = self._forward_decoder(o_en, o_en_dp, dr_mas, x_mask, y_lengths, g=g)
+            dr_mas, mu, log_sigma, logp = self._forward_mdn(o_en, y, x_mask, y_mask)
+            o_de = self._forward_decoder(o_en, o_en_dp, dr_mas, x_mask, y_mask, g=g)
         elif phase == 3:
             # train duration predictor
             o_en, o_en_dp, x_mask, g = self._forward_encoder(x, x_lengths, g)
             o_dr_log = self.duration_predictor(x, x_mask)
-            dr_mas, mu, log_sigma, logp = self._forward_mdn(o_en, y, y_lengths, x_mask)
-            o_de, attn = self._forward_decoder(o_en, o_en_dp, dr_mas, x_mask, y_lengths, g=g)
+            dr_mas, mu, log_sigma, logp = self._forward_mdn(o_en, y, x_mask, y_mask)
+            o_de = self._forward_decoder(o_en, o_en_dp, dr_mas, x_mask, y_mask, g=g)
             o_dr_log = o_dr_log.squeeze(1)
         else:
             o_en, o_en_dp, x_mask, g = self._forward_encoder(x, x_lengths, g)
             o_dr_log = self.duration_predictor(o_en_dp.detach(), x_mask)
-            dr_mas, mu, log_sigma, logp = self._forward_mdn(o_en, y, y_lengths, x_mask)
-            o_de, attn = self._forward_decoder(o_en, o_en_dp, dr_mas, x_mask, y_lengths, g=g)
+            dr_mas, mu, log_sigma, logp = self._forward_mdn(o_en, y, x_mask, y_mask)
+            o_de = self._forward_decoder(o_en, o_en_dp, dr_mas, x_mask, y_mask, g=g)
             o_dr_log = o_dr_log.squeeze(1)
         dr_mas_log = torch.log(dr_mas + 1).squeeze(1)
         outputs = {
             "model_outputs": o_de.transpose(1, 2),
-            "alignments": attn,
+            "durations_mas": dr_mas,  # the dense alignment is only built from these when plotting
             "durations_log": o_dr_log,
             "durations_mas_log": dr_mas_log,
             "mu": mu,
@@ -318,27 +344,46 @@ class AlignTTS(BaseTTS):
         return outputs
 
     @torch.no_grad()
-    def inference(self, x, aux_input={"d_vectors": None}):  # pylint: disable=unused-argument
+    def inference(self, x, aux_input={"x_lengths": None, "d_vectors": None}):  # pylint: disable=unused-argument
         """
+        Padded batches are supported by passing ``x_lengths`` in ``aux_input``, the outputs are then padded
+        to the longest predicted length given in ``y_lengths``.
+
         Shapes:
             - x: :math:`[B, T_max]`
             - x_lengths: :math:`[B]`
             - g: :math:`[B, C]`
         """
         g = aux_input["d_vectors"] if "d_vectors" in aux_input else None
-        x_lengths = torch.tensor(x.shape[1:2]).to(x.device)
+        x_lengths = self._set_x_lengths(x, aux_input)
         # pad input to prevent dropping the last word
         # x = torch.nn.functional.pad(x, pad=(0, 5), mode='constant', value=0)
         o_en, o_en_dp, x_mask, g = self._forward_encoder(x, x_lengths, g)
         # o_dr_log = self.duration_predictor(x, x_mask)
         o_dr_log = self.duration_predictor(o_en_dp, x_mask)
         # duration predictor pass
-        o_dr = self.format_durations(o_dr_log, x_mask).squeeze(1)
+        # padded tokens would otherwise get the minimum duration of one frame
+        o_dr = (self.format_durations(o_dr_log, x_mask) * x_mask).squeeze(1)
         y_lengths = o_dr.sum(1)
-        o_de, attn = self._forward_decoder(o_en, o_en_dp, o_dr, x_mask, y_lengths, g=g)
-        outputs = {"model_outputs": o_de.transpose(1, 2), "alignments": attn}
+        y_mask = torch.unsqueeze(sequence_mask(y_lengths, None), 1).to(o_dr.dtype)
+        # the durations are fixed by now, only the decoder runs in bfloat16
+        # autocast is only entered when asked for, older torch versions reject some device types even when disabled
+        if self.config.model_args.use_bf16_inference:
+            decoder_context = torch.autocast(x.device.type, dtype=torch.bfloat16)
+        else:
+            decoder_context = contextlib.nullcontext()
+        with decoder_context:
+            o_de = self._forward_decoder(o_en, o_en_dp, o_dr, x_mask, y_mask, g=g)
+        attn = self.generate_attn(o_dr, x_mask, y_mask).transpose(1, 2)
+        outputs = {"model_outputs": o_de.to(o_en.dtype).transpose(1, 2), "alignments": attn, "y_lengths": y_lengths}
         return outputs
 
+    @staticmethod
+    def _set_x_lengths(x, aux_input):
+        if "x_lengths" in aux_input and aux_input["x_lengths"] is not None:
+            return aux_input["x_lengths"]
+        return torch.full(x.shape[:1], x.shape[1], dtype=torch.long, device=x.device)
+
     def train_step(self, batch: dict, criterion: nn.Module):
         text_input = batch["text_input"]
         text_lengths = batch["text_lengths"]
@@ -362,14 +407,19 @@ class AlignTTS(BaseTTS):
 
         return outputs, loss_dict
 
-    def _create_logs(self, batch, outputs, ap):  # pylint: disable=no-self-use
+    def _create_logs(self, batch, outputs, ap):
         model_outputs = outputs["model_outputs"]
-        alignments = outputs["alignments"]
         mel_input = batch["mel_input"]
 
+        # build the alignment of the plotted sample only
+        dr = outputs["durations_mas"][:1]
+        x_mask = sequence_mask(batch["text_lengths"][:1], dr.shape[1]).unsqueeze(1).to(dr.dtype)
+        y_mask = sequence_mask(batch["mel_lengths"][:1], mel_input.shape[1]).unsqueeze(1).to(dr.dtype)
+        alignment = self.generate_attn(dr, x_mask, y_mask).transpose(1, 2)
+
         pred_spec = model_outputs[0].data.cpu().numpy()
         gt_spec = mel_input[0].data.cpu().numpy()
-        align_img = alignments[0].data.cpu().numpy()
+        align_img = alignment[0].data.cpu().numpy()
 
         figures = {
             "prediction": plot_spectrogram(pred_spec, ap, output_fig=False),
@@ -414,15 +464,8 @@ class AlignTTS(BaseTTS):
     def _set_phase(config, global_step):
         """Decide AlignTTS training phase"""
         if isinstance(config.phase_start_steps, list):
-            vals = [i < global_step for i in config.phase_start_steps]
-            if not True in vals:
-                phase = 0
-            else:
-                phase = (
-                    len(config.phase_start_steps)
-                    - [i < global_step for i in config.phase_start_steps][::-1].index(True)
-                    - 1
-                )
+            # index of the last phase started strictly before global_step, phase start steps are ascending
+            phase = max(bisect.bisect_left(config.phase_start_steps, global_step) - 1, 0)
         else:
             phase = None
         return phase
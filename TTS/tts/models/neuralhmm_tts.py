@@ -93,6 +93,8 @@ class NeuralhmmTTS(BaseTTS):
             flat_start_params=self.flat_start_params,
             std_floor=self.std_floor,
             use_grad_checkpointing=self.use_grad_checkpointing,
+            grad_checkpointing_chunk_size=self.grad_checkpointing_chunk_size,
+            use_bf16_emissions=self.use_bf16_emissions,
         )
 
         self.register_buffer("mean", torch.tensor(0))
@@ -303,7 +305,7 @@ class NeuralhmmTTS(BaseTTS):
     @torch.inference_mode()
     def _create_logs(self, batch, outputs, ap):  # pylint: disable=no-self-use, unused-argument
         alignments, transition_vectors = outputs["alignments"], outputs["transition_vectors"]
-        means = torch.stack(outputs["means"], dim=1)
+        means = outputs["means"]
 
         figures = {
             "alignment": plot_alignment(alignments[0].exp(), title="Forward alignment", fig_size=(20, 20)),
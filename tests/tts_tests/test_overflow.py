@@ -129,6 +129,19 @@ class TestOverflowUtils(unittest.TestCase):
         a = torch.ones(10)  # all ones
         self.assertTrue(torch.eq(torch.logsumexp(a, dim=0), OverflowUtils.logsumexp(a, dim=0)).all())
 
+    def test_logaddexp(self):
+        a, b = torch.randn(10), torch.randn(10)
+        a[:3] = -float("inf")
+        b[1:4] = -float("inf")
+        expected = OverflowUtils.logsumexp(torch.stack((a, b), dim=1), dim=1)
+        self.assertTrue(torch.allclose(OverflowUtils.logaddexp(a, b), expected, equal_nan=True))
+
+        # all -inf inputs must give 0 gradients rather than nans
+        a = torch.full((4,), -float("inf"), requires_grad=True)
+        b = torch.full((4,), -float("inf"), requires_grad=True)
+        OverflowUtils.logaddexp(a, b).masked_fill(torch.ones(4, dtype=torch.bool), 0.0).sum().backward()
+        self.assertTrue(torch.eq(a.grad, 0).all() and torch.eq(b.grad, 0).all())
+
 
 class TestOverflowDecoder(unittest.TestCase):
     @staticmethod
@@ -176,14 +189,14 @@ class TestOverflowDecoder(unittest.TestCase):
 
 class TestNeuralHMM(unittest.TestCase):
     @staticmethod
-    def _get_neural_hmm(deterministic_transition=None):
+    def _get_neural_hmm(deterministic_transition=None, prenet_type=None, **kwargs):
         config = deepcopy(config_global)
         neural_hmm = NeuralHMM(
             config.out_channels,
             config.ar_order,
             config.deterministic_transition if deterministic_transition is None else deterministic_transition,
             config.encoder_in_out_features,
-            config.prenet_type,
+            config.prenet_type if prenet_type is None else prenet_type,
             config.prenet_dim,
             config.prenet_n_layers,
             config.prenet_dropout,
@@ -192,6 +205,7 @@ class TestNeuralHMM(unittest.TestCase):
             config.outputnet_size,
             config.flat_start_params,
             config.std_floor,
+            **kwargs,
         ).to(device)
         return neural_hmm
 
@@ -218,7 +232,40 @@ class TestNeuralHMM(unittest.TestCase):
             input_dummy, input_lengths, mel_spec.transpose(1, 2), mel_lengths
         )
         self.assertEqual(log_prob.shape, (input_dummy.shape[0],))
+        self.assertEqual(log_alpha_scaled.shape, (*mel_spec.shape[:2], input_dummy.shape[1]))
         self.assertEqual(log_alpha_scaled.shape, transition_matrix.shape)
+        self.assertEqual(means.shape, (1, *log_alpha_scaled.shape[1:], config_global.out_channels))
+        self.assertFalse(means.requires_grad)
+
+    def test_neural_hmm_forward_chunks(self):
+        input_dummy, input_lengths, mel_spec, mel_lengths = _create_inputs(batch_size=2)
+        input_dummy = torch.randn(*input_dummy.shape, config_global.encoder_in_out_features).to(device)
+        mels = mel_spec.transpose(1, 2)
+        T_max = mel_lengths.max().item()
+        for prenet_type in ["original", "bn"]:
+            reference = None
+            for use_grad_checkpointing, chunk_size in [(False, 16), (True, 1), (True, 3), (True, T_max)]:
+                torch.manual_seed(1)
+                neural_hmm = self._get_neural_hmm(
+                    prenet_type=prenet_type,
+                    use_grad_checkpointing=use_grad_checkpointing,
+                    grad_checkpointing_chunk_size=chunk_size,
+                ).train()
+                torch.manual_seed(2)  # same prenet dropout masks in every run
+                log_prob = neural_hmm(input_dummy, input_lengths, mels, mel_lengths)[0]
+                grads = torch.autograd.grad(log_prob.sum(), list(neural_hmm.parameters()), allow_unused=True)
+                if reference is None:
+                    reference = (log_prob, grads)
+                    continue
+                msg = f"prenet_type={prenet_type}, checkpointing={use_grad_checkpointing}, chunk_size={chunk_size}"
+                self.assertTrue(torch.allclose(log_prob, reference[0], rtol=1e-5, atol=1e-5), msg)
+                for grad, grad_ref in zip(grads, reference[1]):
+                    self.assertEqual(grad is None, grad_ref is None, msg)
+                    if grad is not None:
+                        self.assertTrue(torch.allclose(grad, grad_ref, rtol=1e-4, atol=1e-5), msg)
+
+        with self.assertRaises(AssertionError):
+            self._get_neural_hmm(grad_checkpointing_chunk_size=0)
 
     def test_mask_lengths(self):
         input_dummy, input_lengths, mel_spec, mel_lengths = self._get_embedded_input()
@@ -256,55 +303,33 @@ class TestNeuralHMM(unittest.TestCase):
         self.assertEqual(h_post_prenet.shape, (input_dummy.shape[0], config_global.memory_rnn_dim))
         self.assertEqual(c_post_prenet.shape, (input_dummy.shape[0], config_global.memory_rnn_dim))
 
-    def test_add_go_token(self):
+    def test_precompute_memory_inputs(self):
         model = self._get_neural_hmm()
+        model.eval()
         input_dummy, input_lengths, mel_spec, mel_lengths = self._get_embedded_input()
 
-        out = model._add_go_token(mel_spec)  # pylint: disable=protected-access
-        self.assertEqual(out.shape, mel_spec.shape)
-        self.assertTrue((out[:, 1:] == mel_spec[:, :-1]).all(), "Go token not appended properly")
+        ar_inputs = model._add_go_token(mel_spec)  # pylint: disable=protected-access
+        memory_inputs = model._precompute_memory_inputs(ar_inputs)  # pylint: disable=protected-access
+        self.assertEqual(memory_inputs.shape, (mel_spec.shape[0], mel_spec.shape[1], config_global.prenet_dim))
+        for t in [0, 1, mel_spec.shape[1] - 1]:
+            memory_input = model.prenet(ar_inputs[:, t : t + model.ar_order].flatten(1))
+            self.assertTrue(torch.allclose(memory_inputs[:, t], memory_input, atol=1e-6))
 
-    def test_forward_algorithm_variables(self):
+    def test_add_go_token(self):
         model = self._get_neural_hmm()
         input_dummy, input_lengths, mel_spec, mel_lengths = self._get_embedded_input()
 
-        (
-            log_c,
-            log_alpha_scaled,
-            transition_matrix,
-            _,
-        ) = model._initialize_forward_algorithm_variables(  # pylint: disable=protected-access
-            mel_spec, input_dummy.shape[1] * config_global.state_per_phone
-        )
-
-        self.assertEqual(log_c.shape, (mel_spec.shape[0], mel_spec.shape[1]))
-        self.assertEqual(
-            log_alpha_scaled.shape,
-            (
-                mel_spec.shape[0],
-                mel_spec.shape[1],
-                input_dummy.shape[1] * config_global.state_per_phone,
-            ),
-        )
-        self.assertEqual(
-            transition_matrix.shape,
-            (mel_spec.shape[0], mel_spec.shape[1], input_dummy.shape[1] * config_global.state_per_phone),
-        )
+        out = model._add_go_token(mel_spec)  # pylint: disable=protected-access
+        self.assertEqual(out.shape, mel_spec.shape)
+        self.assertTrue((out[:, 1:] == mel_spec[:, :-1]).all(), "Go token not appended properly")
 
     def test_get_absorption_state_scaling_factor(self):
         model = self._get_neural_hmm()
         input_dummy, input_lengths, mel_spec, mel_lengths = self._get_embedded_input()
         input_lengths = input_lengths * config_global.state_per_phone
-        (
-            log_c,
-            log_alpha_scaled,
-            transition_matrix,
-            _,
-        ) = model._initialize_forward_algorithm_variables(  # pylint: disable=protected-access
-            mel_spec, input_dummy.shape[1] * config_global.state_per_phone
-        )
-        log_alpha_scaled = torch.rand_like(log_alpha_scaled).clamp(1e-3)
-        transition_matrix = torch.randn_like(transition_matrix).sigmoid().log()
+        N = input_dummy.shape[1] * config_global.state_per_phone
+        log_alpha_scaled = torch.rand(mel_spec.shape[0], mel_spec.shape[1], N).to(device).clamp(1e-3)
+        transition_matrix = torch.randn(mel_spec.shape[0], mel_spec.shape[1], N).to(device).sigmoid().log()
         sum_final_log_c = model.get_absorption_state_scaling_factor(
             mel_lengths, log_alpha_scaled, input_lengths, transition_matrix
         )
@@ -347,6 +372,29 @@ class TestNeuralHMM(unittest.TestCase):
         out = model(x_t, means, std, input_lengths)
         self.assertEqual(out.shape, (input_dummy.shape[0], input_dummy.shape[1]))
 
+        # all the timesteps at once should match the timestep by timestep computation
+        x = torch.randn(input_dummy.shape[0], 5, config_global.out_channels).to(device)
+        means_all = torch.randn(input_dummy.shape[0], 5, input_dummy.shape[1], config_global.out_channels).to(device)
+        std_all = torch.rand_like(means_all).clamp_(1e-3)
+        out_all = model(x, means_all, std_all, input_lengths)
+        self.assertEqual(out_all.shape, (input_dummy.shape[0], 5, input_dummy.shape[1]))
+        for t in range(5):
+            out_t = model(x[:, t], means_all[:, t], std_all[:, t], input_lengths)
+            self.assertTrue(torch.allclose(out_all[:, t], out_t, atol=1e-5))
+
+        # bfloat16 log probabilities are still reduced into the input dtype
+        out_bf16 = EmissionModel(compute_dtype=torch.bfloat16).to(device)(x, means_all, std_all, input_lengths)
+        self.assertEqual(out_bf16.dtype, out_all.dtype)
+        self.assertTrue(torch.allclose(out_bf16, out_all, rtol=5e-2))
+        # a trained model puts the means close to the observations with small stds
+        means_close = x.unsqueeze(-2) + 1e-3 * torch.randn_like(means_all)
+        std_small = 1e-3 + 1e-3 * torch.rand_like(means_all)
+        out_close = model(x, means_close, std_small, input_lengths)
+        out_close_bf16 = EmissionModel(compute_dtype=torch.bfloat16).to(device)(
+            x, means_close, std_small, input_lengths
+        )
+        self.assertTrue(torch.allclose(out_close_bf16, out_close, rtol=1e-2))
+
         # testing sampling
         for temp in [0, 0.334, 0.667]:
             out = model.sample(means, std, 0)
@@ -359,7 +407,7 @@ class TestNeuralHMM(unittest.TestCase):
         input_dummy, input_lengths, mel_spec, mel_lengths = self._get_embedded_input()
         prev_t_log_scaled_alph = torch.randn(input_dummy.shape[0], input_lengths.max()).to(device)
         transition_vector = torch.randn(input_lengths.max()).to(device)
-        out = model(prev_t_log_scaled_alph, transition_vector, input_lengths)
+        out = model(prev_t_log_scaled_alph, transition_vector, sequence_mask(input_lengths))
         self.assertEqual(out.shape, (input_dummy.shape[0], input_lengths.max()))
 
 
@@ -0,0 +1,153 @@
+import torch as T
+
+from TTS.tts.configs.align_tts_config import AlignTTSConfig
+from TTS.tts.models.align_tts import AlignTTS, AlignTTSArgs
+from TTS.tts.utils.helpers import sequence_mask
+
+# pylint: disable=unused-variable
+
+
+def _create_model(**kwargs):
+    params = {"hidden_channels_ffn": 64, "num_heads": 2, "num_layers": 2, "dropout_p": 0.1}
+    model_args = {
+        "num_chars": 24,
+        "hidden_channels": 32,
+        "hidden_channels_dp": 32,
+        "encoder_params": params,
+        "decoder_params": params,
+    }
+    model_args.update(kwargs)
+    args = AlignTTSArgs(**model_args)
+    model = AlignTTS(AlignTTSConfig(model_args=args))
+    # spread the predicted durations of the untrained model over a few frames
+    model.duration_predictor.layers[-1].bias.data.fill_(1.5)
+    return model.eval()
+
+
+def test_inference_bf16_durations():
+    T.manual_seed(1)
+    model = _create_model()
+    x = T.randint(0, 24, (2, 17))
+    x_lengths = T.tensor([17, 11])
+
+    outputs = model.inference(x, aux_input={"x_lengths": x_lengths})
+    model.config.model_args.use_bf16_inference = True
+    outputs_bf16 = model.inference(x, aux_input={"x_lengths": x_lengths})
+
+    assert T.equal(outputs["y_lengths"], outputs_bf16["y_lengths"])
+    assert T.equal(outputs["alignments"], outputs_bf16["alignments"])
+    assert outputs_bf16["model_outputs"].dtype == T.float32
+    assert outputs_bf16["model_outputs"].shape == outputs["model_outputs"].shape
+
+
+def test_gather_encoder_outputs():
+    en = T.rand(2, 5, 9)
+    durations = T.randint(0, 4, (2, 9)).float()
+    durations[0, 2] = 0  # zero duration token
+    x_lengths = T.tensor([9, 6])
+    x_mask = sequence_mask(x_lengths, 9).unsqueeze(1).float()
+    # padded tokens keep nonzero durations and the decoder mask runs past the total duration
+    durations[1, 6:] = 2
+    y_mask = T.ones(2, 1, int(durations.sum(1).max()) + 3)
+
+    expanded = AlignTTS.gather_encoder_outputs(en, durations, x_mask, y_mask)
+
+    attn = AlignTTS.generate_attn(durations, x_mask, y_mask)
+    expected = T.matmul(attn.squeeze(1).transpose(1, 2), en.transpose(1, 2)).transpose(1, 2)
+    assert expanded.shape == expected.shape
+    assert T.allclose(expanded, expected)
+
+
+def _compute_log_probs_broadcast(mu, log_sigma, y):
+    y = y.transpose(1, 2).unsqueeze(1)  # [B, 1, T1, D]
+    mu = mu.transpose(1, 2).unsqueeze(2)  # [B, T2, 1, D]
+    log_sigma = log_sigma.transpose(1, 2).unsqueeze(2)  # [B, T2, 1, D]
+    expanded_y, expanded_mu = T.broadcast_tensors(y, mu)
+    exponential = -0.5 * T.mean(
+        T.nn.functional.mse_loss(expanded_y, expanded_mu, reduction="none") / T.pow(log_sigma.exp(), 2), dim=-1
+    )  # B, L, T
+    return exponential - 0.5 * log_sigma.mean(dim=-1)
+
+
+def test_compute_log_probs():
+    T.manual_seed(1)
+    mu = T.randn(2, 8, 7, dtype=T.float64, requires_grad=True)
+    log_sigma = (0.5 * T.randn(2, 8, 7, dtype=T.float64)).requires_grad_()
+    y = T.randn(2, 8, 13, dtype=T.float64, requires_grad=True)
+    grad_out = T.randn(2, 7, 13, dtype=T.float64)
+
+    logp = AlignTTS.compute_log_probs(mu, log_sigma, y)
+    grads = T.autograd.grad(logp, (mu, log_sigma, y), grad_out)
+    logp_ref = _compute_log_probs_broadcast(mu, log_sigma, y)
+    grads_ref = T.autograd.grad(logp_ref, (mu, log_sigma, y), grad_out)
+
+    assert logp.shape == (2, 7, 13)
+    assert T.allclose(logp, logp_ref)
+    for grad, grad_ref in zip(grads, grads_ref):
+        assert T.allclose(grad, grad_ref)
+
+
+def _check_padded_batch_inference(model):
+    x = T.randint(0, 24, (3, 17))
+    x_lengths = T.tensor([17, 11, 6])
+
+    outputs = model.inference(x, aux_input={"x_lengths": x_lengths})
+
+    durations = outputs["alignments"].sum(1)  # [B, T_en]
+    assert outputs["model_outputs"].shape[1] == outputs["y_lengths"].max()
+    for b in range(x.shape[0]):
+        x_len = x_lengths[b].item()
+        y_len = int(outputs["y_lengths"][b].item())
+        single = model.inference(x[b : b + 1, :x_len])
+        assert outputs["y_lengths"][b] == single["y_lengths"][0]
+        assert durations[b, x_len:].sum() == 0
+        assert T.equal(durations[b, :x_len], single["alignments"][0].sum(0))
+        assert T.allclose(outputs["model_outputs"][b, :y_len], single["model_outputs"][0], atol=1e-5)
+
+
+def test_inference_padded_batch():
+    T.manual_seed(1)
+    _check_padded_batch_inference(_create_model())
+
+
+def test_inference_padded_batch_relative_position_transformer():
+    T.manual_seed(1)
+    params = {
+        "hidden_channels_ffn": 64,
+        "num_heads": 2,
+        "kernel_size": 3,
+        "dropout_p": 0.1,
+        "num_layers": 2,
+        "rel_attn_window_size": 4,
+        "input_length": None,
+    }
+    model = _create_model(
+        encoder_type="relative_position_transformer",
+        encoder_params=params,
+        decoder_type="relative_position_transformer",
+        decoder_params=params,
+    )
+    _check_padded_batch_inference(model)
+
+
+def test_format_durations():
+    model = _create_model(length_scale=1.5)
+    o_dr_log = T.randn(2, 1, 13) + 1
+    x_mask = sequence_mask(T.tensor([13, 8]), 13).unsqueeze(1).float()
+
+    durations = model.format_durations(o_dr_log, x_mask)
+
+    expected = (T.exp(o_dr_log) - 1) * x_mask * 1.5
+    expected[expected < 1] = 1.0
+    expected = T.round(expected)
+    assert T.equal(durations, expected)
+
+
+def test_set_phase():
+    config = AlignTTSConfig(phase_start_steps=[0, 40, 80, 160, 170])
+    for global_step in range(200):
+        # the phase is the last one that started strictly before global_step
+        started = [i for i, step in enumerate(config.phase_start_steps) if step < global_step]
+        expected = started[-1] if started else 0
+        assert AlignTTS._set_phase(config, global_step) == expected  # pylint: disable=protected-access
+    assert AlignTTS._set_phase(AlignTTSConfig(), 10) is None  # pylint: disable=protected-access